@@ -1,18 +1,25 @@
 from fastapi import FastAPI, Request, Form, UploadFile, File, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, JSONResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-import aiofiles
+from fastapi.concurrency import run_in_threadpool
 import os
+import functools
+import operator
 import logging
-import json
+import logging.handlers
+import queue
+import orjson
 import hashlib
+import hmac
 import urllib.parse
 from pathlib import Path
 from datetime import datetime
 from typing import Optional, List, Dict
 import unicodedata
 import socket
+import threading
+import time
 
 VIDEO_DIR = os.getenv("NAS_MEDIA_VIDEO_DIR", "/mnt")
 PORT = int(os.getenv("NAS_MEDIA_PORT", 8800))
@@ -22,18 +29,32 @@ LOG_FILE = os.getenv("NAS_MEDIA_LOG_FILE", os.path.join(APP_DIR, "nas-media-play
 
 log_dir = os.path.dirname(LOG_FILE)
 os.makedirs(log_dir, exist_ok=True)
+
+# 日志经队列转发：请求线程只入队，磁盘/终端写入在监听线程完成，不阻塞事件循环
+_log_queue = queue.SimpleQueue()
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# 入队时只合并message参数，时间戳等格式化留给监听线程的handler
+_log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
+    handlers=[_log_queue_handler]
+)
+_log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+_log_file_handler = logging.FileHandler(LOG_FILE)
+_log_file_handler.setFormatter(_log_formatter)
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(_log_formatter)
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, _log_file_handler, _log_stream_handler
 )
 logger = logging.getLogger(__name__)
 
 # 配置路径
 VIDEO_ROOT = Path(VIDEO_DIR).resolve()
+VIDEO_ROOT_STR = str(VIDEO_ROOT)
+VIDEO_ROOT_PARTS = VIDEO_ROOT.parts
+STATIC_DIR = Path(APP_DIR) / "static"
+INDEX_HTML_PATH = STATIC_DIR / "index.html"
 PASSWORD_FILE = Path(APP_DIR) / "dir_passwords.json"
 
 def path_is_relative_to(path: Path, base: Path) -> bool:
@@ -51,7 +72,8 @@ def path_relative_to(path: Path, base: Path) -> str:
     except ValueError:
         return str(path)
 
-app = FastAPI(title="NAS 轻量媒体播放器")
+# orjson序列化比stdlib json快2-4倍且直接产出bytes，目录树这类MB级响应受益明显
+app = FastAPI(title="NAS 轻量媒体播放器", default_response_class=ORJSONResponse)
 
 # 添加CORS中间件
 app.add_middleware(
@@ -101,10 +123,25 @@ SUPPORTED_AUDIO_FORMATS = {
 
 # 合并所有支持的格式
 SUPPORTED_FORMATS = {**SUPPORTED_VIDEO_FORMATS, **SUPPORTED_IMAGE_FORMATS, **SUPPORTED_AUDIO_FORMATS}
-SUPPORTED_EXTENSIONS = list(SUPPORTED_FORMATS.keys())
+SUPPORTED_EXTENSIONS = frozenset(SUPPORTED_FORMATS)
+
+def get_file_ext(name: str) -> str:
+    """提取小写扩展名，避免为取后缀单独构造Path对象"""
+    return os.path.splitext(name)[1].lower()
+
+# 扩展名 -> (MIME类型, 媒体类别)，一次dict查找同时完成格式校验与分类
+EXT_INFO: Dict[str, tuple] = {
+    **{ext: (mime, "video") for ext, mime in SUPPORTED_VIDEO_FORMATS.items()},
+    **{ext: (mime, "audio") for ext, mime in SUPPORTED_AUDIO_FORMATS.items()},
+    **{ext: (mime, "image") for ext, mime in SUPPORTED_IMAGE_FORMATS.items()},
+}
 
 # 挂载静态文件
-app.mount("/static", StaticFiles(directory=Path(APP_DIR) / "static"), name="static")
+app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+
+# 首页启动时读入内存并算好ETag，访问首页不再每次stat+open磁盘
+_INDEX_BYTES = INDEX_HTML_PATH.read_bytes()
+_INDEX_ETAG = f'"{hashlib.md5(_INDEX_BYTES).hexdigest()}"'
 
 def get_safe_cookie_key(dir_path: str) -> str:
     """将目录路径转换为MD5哈希值，避免Cookie键名包含非法字符"""
@@ -114,95 +151,115 @@ def get_safe_cookie_key(dir_path: str) -> str:
 
 # 密码管理功能
 def init_password_file():
-    """初始化密码文件（修复目录创建+合法JSON写入）"""
+    """初始化密码文件（仅启动时调用，修复目录创建+合法JSON写入）"""
     app_dir = Path(APP_DIR)
     app_dir.mkdir(parents=True, exist_ok=True)
 
     if not PASSWORD_FILE.exists():
-        with open(PASSWORD_FILE, 'w', encoding='utf-8') as f:
-            json.dump({}, f)
+        PASSWORD_FILE.write_bytes(orjson.dumps({}))
     else:
         try:
-            with open(PASSWORD_FILE, 'r', encoding='utf-8') as f:
-                json.load(f)
-        except json.JSONDecodeError:
-            with open(PASSWORD_FILE, 'w', encoding='utf-8') as f:
-                json.dump({}, f)
+            orjson.loads(PASSWORD_FILE.read_bytes())
+        except orjson.JSONDecodeError:
+            PASSWORD_FILE.write_bytes(orjson.dumps({}))
 
 def hash_password(password: str) -> str:
     """密码哈希"""
     return hashlib.sha256(password.encode()).hexdigest()
 
+# 密码文件内存缓存：按 mtime 失效，避免每次请求都重新读盘+解析JSON
+_PW_CACHE = {"mtime": 0, "data": {}, "trie": {}}
+_PW_CACHE_LOCK = threading.Lock()
+_PW_WRITE_LOCK = threading.Lock()
+
+def _build_protected_trie(data: Dict) -> Dict:
+    """按路径段构建受保护目录前缀树，节点的 __protected__ 记录原始路径"""
+    trie = {}
+    for pdir in data:
+        node = trie
+        for seg in pdir.replace(os.sep, '/').rstrip('/').split('/'):
+            node = node.setdefault(seg, {})
+        node["__protected__"] = pdir
+    return trie
+
+def _match_protected(dir_path: str) -> Optional[str]:
+    """沿前缀树查找dir_path的最浅受保护祖先目录，无命中返回None"""
+    node = _load_passwords()["trie"]
+    for seg in dir_path.replace(os.sep, '/').rstrip('/').split('/'):
+        node = node.get(seg)
+        if node is None:
+            return None
+        protected = node.get("__protected__")
+        if protected is not None:
+            return protected
+    return None
+
+def _load_passwords() -> Dict:
+    """加载密码数据（内存缓存，文件mtime变化时才重新读取）"""
+    try:
+        st = PASSWORD_FILE.stat()
+    except OSError:
+        init_password_file()
+        st = PASSWORD_FILE.stat()
+
+    if st.st_mtime_ns != _PW_CACHE["mtime"]:
+        with _PW_CACHE_LOCK:
+            # 双重检查，避免并发重复加载
+            if st.st_mtime_ns != _PW_CACHE["mtime"]:
+                try:
+                    data = orjson.loads(PASSWORD_FILE.read_bytes())
+                except orjson.JSONDecodeError:
+                    init_password_file()
+                    data = {}
+                _PW_CACHE["data"] = data
+                _PW_CACHE["trie"] = _build_protected_trie(data)
+                _PW_CACHE["mtime"] = st.st_mtime_ns
+    return _PW_CACHE
+
 def save_directory_password(dir_path: str, password: str):
-    """保存目录密码"""
-    init_password_file()
-    with open(PASSWORD_FILE, 'r+') as f:
-        data = json.load(f)
+    """保存目录密码（写锁+临时文件原子替换，防止并发写损坏JSON）"""
+    with _PW_WRITE_LOCK:
+        data = dict(_load_passwords()["data"])
         data[dir_path] = {
             "password_hash": hash_password(password),
             "created_at": datetime.now().isoformat()
         }
-        f.seek(0)
-        json.dump(data, f, indent=2)
-        f.truncate()
+        tmp_file = PASSWORD_FILE.with_suffix('.json.tmp')
+        tmp_file.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        # POSIX上rename原子生效，读方永远看不到半截文件
+        os.replace(tmp_file, PASSWORD_FILE)
+        with _PW_CACHE_LOCK:
+            _PW_CACHE["data"] = data
+            _PW_CACHE["trie"] = _build_protected_trie(data)
+            _PW_CACHE["mtime"] = PASSWORD_FILE.stat().st_mtime_ns
 
 def get_directory_password(dir_path: str) -> Optional[str]:
     """获取目录密码哈希"""
-    init_password_file()
-    if not PASSWORD_FILE.exists():
-        return None
-    with open(PASSWORD_FILE, 'r') as f:
-        data = json.load(f)
-        return data.get(dir_path, {}).get("password_hash")
+    return _load_passwords()["data"].get(dir_path, {}).get("password_hash")
 
 def check_directory_password(dir_path: str, password: str) -> bool:
     """验证目录密码"""
     stored_hash = get_directory_password(dir_path)
     if not stored_hash:
         return True
-    return stored_hash == hash_password(password)
+    return hmac.compare_digest(stored_hash, hash_password(password))
 
 def get_protected_directories() -> List[str]:
     """获取所有受保护的目录"""
-    init_password_file()
-    with open(PASSWORD_FILE, 'r') as f:
-        data = json.load(f)
-        return list(data.keys())
+    return list(_load_passwords()["data"].keys())
 
 def is_protected_directory(dir_path: str) -> bool:
     """检查目录是否受保护（修复路径匹配逻辑）"""
     if not dir_path:
         return False
-    protected_dirs = get_protected_directories()
-    dir_path_normalized = dir_path.replace(os.sep, '/').rstrip('/')
-    protected_dirs_normalized = [pdir.replace(os.sep, '/').rstrip('/') for pdir in protected_dirs]
-    
-    for pdir in protected_dirs_normalized:
-        if dir_path_normalized == pdir or dir_path_normalized.startswith(f"{pdir}/"):
-            return True
-    return False
+    return _match_protected(dir_path) is not None
 
 def get_top_protected_directory(dir_path: str) -> Optional[str]:
     """获取目录所属的顶级受保护目录（兼容Python 3.8-）"""
-    if not dir_path or not is_protected_directory(dir_path):
+    if not dir_path:
         return None
-    
-    # 统一路径分隔符为/，便于匹配
-    dir_path_normalized = dir_path.replace(os.sep, '/').rstrip('/')
-    protected_dirs = get_protected_directories()
-    protected_dirs_normalized = [pdir.replace(os.sep, '/').rstrip('/') for pdir in protected_dirs]
-    
-    top_dir = None
-    max_depth = -1
-    
-    for pdir, pdir_original in zip(protected_dirs_normalized, protected_dirs):
-        if dir_path_normalized == pdir or dir_path_normalized.startswith(f"{pdir}/"):
-            depth = pdir.count('/')
-            if top_dir is None or depth < max_depth:
-                max_depth = depth
-                top_dir = pdir_original
-    
-    return top_dir
+    # 前缀树按路径段逐层匹配，首个命中即最浅的受保护祖先
+    return _match_protected(dir_path)
 
 async def verify_dir_access(request: Request, dir_path: str) -> bool:
     """验证目录访问权限（简化逻辑，避免误拦截）"""
@@ -218,8 +275,10 @@ async def verify_dir_access(request: Request, dir_path: str) -> bool:
     cookie_value = request.cookies.get(cookie_key)
     stored_hash = get_directory_password(top_protected_dir)
     
-    # 兼容Cookie不存在的情况
-    if cookie_value and stored_hash and cookie_value == stored_hash:
+    # 兼容Cookie不存在的情况；Cookie里存的就是哈希值，恒定时间比较防时序侧信道
+    # compare_digest遇到非ASCII会抛TypeError，畸形Cookie直接按验证失败处理
+    if cookie_value and stored_hash and cookie_value.isascii() \
+            and hmac.compare_digest(cookie_value, stored_hash):
         logger.info(f"目录访问验证通过: {dir_path} (Cookie认证)")
         return True
     
@@ -228,49 +287,124 @@ async def verify_dir_access(request: Request, dir_path: str) -> bool:
 
 # 根路径返回前端页面
 @app.get("/", response_class=HTMLResponse)
-async def read_root():
-    return FileResponse(str(Path(APP_DIR) / "static" / "index.html"))
+async def read_root(request: Request):
+    if request.headers.get("if-none-match") == _INDEX_ETAG:
+        return Response(status_code=304, headers={"ETag": _INDEX_ETAG})
+    return HTMLResponse(_INDEX_BYTES, headers={"ETag": _INDEX_ETAG})
+
+@functools.lru_cache(maxsize=4096)
+def _resolve_under_root(subpath: str) -> Optional[Path]:
+    """解析VIDEO_ROOT下的子路径，越界返回None
+
+    VIDEO_ROOT运行期不变，resolve()结果按子路径缓存，
+    避免网络文件系统上每次请求的逐级readlink往返。
+    """
+    resolved = (VIDEO_ROOT / subpath).resolve()
+    if resolved.parts[:len(VIDEO_ROOT_PARTS)] != VIDEO_ROOT_PARTS:
+        return None
+    return resolved
 
 # 安全检查路径（兼容Python 3.8及以下版本）
 def safe_join(base: Path, *paths) -> Path:
+    """安全拼接路径。调用方需传入已解码的路径（FastAPI的查询/表单参数已解码）"""
     try:
-        decoded_paths = [urllib.parse.unquote(path) for path in paths]
-        joined_path = base.joinpath(*decoded_paths).resolve()
-        joined_path.relative_to(base)
-        return joined_path
-    except ValueError:
-        logger.error(f"路径越权：{joined_path} 不在 {base} 范围内")
-        raise HTTPException(status_code=403, detail="无效路径（越权访问）")
+        if base is VIDEO_ROOT:
+            resolved = _resolve_under_root('/'.join(paths))
+        else:
+            joined_path = base.joinpath(*paths).resolve()
+            resolved = joined_path if joined_path.parts[:len(base.parts)] == base.parts else None
+        if resolved is None:
+            logger.error(f"路径越权：{paths} 不在 {base} 范围内")
+            raise HTTPException(status_code=403, detail="无效路径（越权访问）")
+        return resolved
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Path security check failed: {e}")
         raise HTTPException(status_code=403, detail="Invalid path")
 
+# 目录扫描结果内存缓存：目录mtime未变且未过TTL时直接复用，免去对NAS的重复scandir
+# TTL兜底应对mtime精度不足的文件系统
+_DIR_CACHE: Dict[str, tuple] = {}    # 目录路径 -> (st_mtime_ns, 缓存时刻, 子目录名列表)
+_MEDIA_CACHE: Dict[str, tuple] = {}  # 目录路径 -> (st_mtime_ns, 缓存时刻, 媒体文件列表)
+DIR_CACHE_TTL = 5.0
+
+def _list_subdirs(path: str, nocache: bool = False) -> List[str]:
+    """列出path下的子目录名（带mtime+TTL失效的内存缓存）"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return []
+    now = time.monotonic()
+    cached = _DIR_CACHE.get(path)
+    if cached and not nocache and cached[0] == mtime and now - cached[1] < DIR_CACHE_TTL:
+        return cached[2]
+    names = []
+    try:
+        # scandir复用readdir返回的d_type，is_dir不触发额外stat
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.'):
+                    names.append(entry.name)
+    except OSError as e:
+        logger.error(f"Directory scan error: {e}")
+    _DIR_CACHE[path] = (mtime, now, names)
+    return names
+
 # 获取目录结构
 @app.get("/api/directories")
-async def get_directories():
-    dirs = []
-    protected_dirs = get_protected_directories()
-    
-    def traverse_recursive_dirs(path: Path, rel_path: str = "") -> List[Dict]:
+async def get_directories(nocache: bool = False, path: Optional[str] = None,
+                          depth: Optional[int] = None):
+    root_trie = _load_passwords()["trie"]
+
+    # 只缓存每个目录的子目录名；protected标记依赖密码文件，每次请求基于前缀树重新组装
+    def traverse_recursive_dirs(abs_path: str, rel_path: str = "",
+                                trie_node: Optional[Dict] = None,
+                                inherited_protected: bool = False,
+                                remaining: Optional[int] = None) -> List[Dict]:
         items = []
         try:
-            for dir in path.iterdir():
-                if dir.is_dir() and not dir.name.startswith('.'):
-                    sub_rel = f"{rel_path}/{dir.name}" if rel_path else dir.name
-                    is_protected = is_protected_directory(sub_rel)
-                    items.append({
-                        "name": dir.name,
-                        "path": sub_rel,
-                        "type": "directory",
-                        "protected": is_protected,
-                        "children": traverse_recursive_dirs(dir, sub_rel)
-                    })
+            for name in _list_subdirs(abs_path, nocache):
+                sub_rel = f"{rel_path}/{name}" if rel_path else name
+                # 沿前缀树下钻，每个子目录只查一次dict，无需重扫全部受保护目录
+                child_node = trie_node.get(name) if trie_node else None
+                is_protected = inherited_protected or (
+                    child_node is not None and "__protected__" in child_node
+                )
+                children = []
+                if remaining is None or remaining > 1:
+                    children = traverse_recursive_dirs(
+                        os.path.join(abs_path, name), sub_rel, child_node, is_protected,
+                        None if remaining is None else remaining - 1)
+                items.append({
+                    "name": name,
+                    "path": sub_rel,
+                    "type": "directory",
+                    "protected": is_protected,
+                    "children": children
+                })
         except Exception as e:
             logger.error(f"Directory traversal error: {e}")
         return items
-    
-    if VIDEO_ROOT.exists():
-        dirs = traverse_recursive_dirs(VIDEO_ROOT)
+
+    def build_tree() -> List[Dict]:
+        # path+depth支持子树懒加载：前端可按需展开，不必每次都走完整棵树
+        if path and path.strip():
+            start_dir = safe_join(VIDEO_ROOT, path.strip())
+            if not start_dir.exists() or not start_dir.is_dir():
+                return []
+            rel = path.strip().strip('/')
+            node = root_trie
+            for seg in rel.split('/'):
+                node = node.get(seg) if node else None
+            inherited = _match_protected(rel) is not None
+            return traverse_recursive_dirs(str(start_dir), rel, node, inherited, depth)
+        if VIDEO_ROOT.exists():
+            return traverse_recursive_dirs(str(VIDEO_ROOT), "", root_trie, False, depth)
+        return []
+
+    # 整个遍历放到工作线程，慢速NAS不会卡住事件循环
+    dirs = await run_in_threadpool(build_tree)
     return {"directories": dirs}
 
 
@@ -314,13 +448,54 @@ async def check_dir_access(dir_path: str, request: Request) -> bool:
     cookie_value = request.cookies.get(cookie_key)
     stored_hash = get_directory_password(top_protected_dir)
     
-    if cookie_value and cookie_value == stored_hash:
+    # compare_digest遇到非ASCII会抛TypeError，畸形Cookie直接按验证失败处理
+    if cookie_value and stored_hash and cookie_value.isascii() \
+            and hmac.compare_digest(cookie_value, stored_hash):
         return True
-    
+
     return False
 
+def _list_media_files(target_dir: str, nocache: bool = False) -> List[Dict]:
+    """列出目录中的媒体文件（带mtime+TTL失效的内存缓存，结果已排序）"""
+    try:
+        mtime = os.stat(target_dir).st_mtime_ns
+    except OSError:
+        return []
+    now = time.monotonic()
+    cached = _MEDIA_CACHE.get(target_dir)
+    if cached and not nocache and cached[0] == mtime and now - cached[1] < DIR_CACHE_TTL:
+        return cached[2]
+
+    media = []
+    sort_keys = []
+    with os.scandir(target_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                ext = get_file_ext(entry.name)
+                info = EXT_INFO.get(ext)
+                if info is not None:
+                    file_type = info[1]
+
+                    # 只stat一次，size/mtime复用同一结果
+                    st = entry.stat()
+                    media.append({
+                        "name": entry.name,
+                        "type": file_type,
+                        "extension": ext,
+                        "size": st.st_size,
+                        "modified": st.st_mtime,
+                        "path": entry.path
+                    })
+                    # 构建时顺手算好排序键，排序阶段不再做dict查找
+                    sort_keys.append((len(entry.name), entry.name.casefold()))
+
+    # 按文件名自然排序（长度优先，casefold保证大小写/本地化一致）
+    media = [item for _, item in sorted(zip(sort_keys, media), key=operator.itemgetter(0))]
+    _MEDIA_CACHE[target_dir] = (mtime, now, media)
+    return media
+
 @app.get("/api/media")
-async def get_media(subdir: Optional[str] = None, request: Request = None):
+async def get_media(subdir: Optional[str] = None, request: Request = None, nocache: bool = False):
     try:
         if subdir and not await check_dir_access(subdir, request):
             return {
@@ -337,33 +512,10 @@ async def get_media(subdir: Optional[str] = None, request: Request = None):
             
         if not target_dir.exists() or not target_dir.is_dir():
             return {"media": [], "current_dir": subdir or ""}
-        
-        media = []
-
-        for file in target_dir.iterdir():
-            if file.is_file():
-                ext = file.suffix.lower()
-                if ext in SUPPORTED_EXTENSIONS:
-                    if ext in SUPPORTED_VIDEO_FORMATS:
-                        file_type = "video"
-                    elif ext in SUPPORTED_AUDIO_FORMATS:
-                        file_type = "audio"
-                    else:
-                        file_type = "image"
-                    
-                    media.append({
-                        "name": file.name,
-                        "type": file_type,
-                        "extension": ext,
-                        "size": file.stat().st_size,
-                        "modified": file.stat().st_mtime,
-                        "path": str(file)
-                    })
-        
-        # 按文件名自然排序
-        media.sort(key=lambda x: (len(x["name"]), x["name"]))
-        logger.info(f"Found {len(media)} media files in {target_dir}")
-        
+
+        media = _list_media_files(str(target_dir), nocache)
+        logger.debug(f"Found {len(media)} media files in {target_dir}")
+
         return {
             "media": media,
             "current_dir": subdir or "",
@@ -377,12 +529,26 @@ async def get_media(subdir: Optional[str] = None, request: Request = None):
 # 编码文件名用于HTTP头
 def encode_filename_for_header(filename: str) -> str:
     """编码文件名以支持中文等特殊字符"""
-    try:
-        filename.encode('ascii')
-        return filename
-    except UnicodeEncodeError:
-        return urllib.parse.quote(filename)
+    # isascii是C层快速判断，非ASCII文件名不再走抛/接异常的慢路径
+    return filename if filename.isascii() else urllib.parse.quote(filename)
+
 
+class MediaFileResponse(FileResponse):
+    """以1MiB块流式发送的FileResponse
+
+    Starlette默认64KiB一块，每块都经线程池读一次再回事件循环发一次；
+    大视频按1MiB发，单位字节的调度开销降到1/16。
+    """
+    chunk_size = 1024 * 1024
+
+# 小文件（缩略图等）直接缓存在内存里整发；阈值以上仍走FileResponse
+SMALL_FILE_CACHE_LIMIT = 256 * 1024
+
+@functools.lru_cache(maxsize=256)
+def _read_small_file(path: str, mtime_ns: int, size: int) -> bytes:
+    """读取小文件字节（mtime/size入缓存键，文件变化自动失效）"""
+    with open(path, 'rb') as f:
+        return f.read()
 
 @app.get("/api/media/{path:path}")
 async def serve_media(path: str, request: Request):
@@ -401,104 +567,56 @@ async def serve_media(path: str, request: Request):
                 content={"error": "Media file not found"}
             )
         
-        ext = full_media_path.suffix.lower()
-        if ext not in SUPPORTED_EXTENSIONS:
+        ext = get_file_ext(full_media_path.name)
+        info = EXT_INFO.get(ext)
+        if info is None:
             return JSONResponse(
                 status_code=400,
                 content={"error": f"Unsupported format: {ext}"}
             )
-        
-        mime_type = SUPPORTED_FORMATS.get(ext, "application/octet-stream")
-        
-        # 处理图片
-        if ext in SUPPORTED_IMAGE_FORMATS:
-            logger.info(f"Serving image: {full_media_path}")
-            
-            # 处理中文文件名的HTTP头
-            filename = full_media_path.name
-            encoded_filename = encode_filename_for_header(filename)
-            
-            headers = {
-                "Cache-Control": "max-age=3600",
-                "Content-Disposition": f"inline; filename=\"{encoded_filename}\"; filename*=UTF-8''{encoded_filename}"
-            }
-            
-            return FileResponse(
-                path=str(full_media_path),
-                media_type=mime_type,
-                filename=encoded_filename,
-                headers=headers
-            )
-        
-        # 处理音频
-        elif ext in SUPPORTED_AUDIO_FORMATS:
-            logger.info(f"Serving audio: {full_media_path}")
-            
-            # 处理中文文件名的HTTP头
-            filename = full_media_path.name
-            encoded_filename = encode_filename_for_header(filename)
-            
+
+        mime_type, file_type = info
+
+        # 处理中文文件名的HTTP头（三个分支共用，只编码一次）
+        encoded_filename = encode_filename_for_header(full_media_path.name)
+
+        # 处理图片/音频：ETag支持304协商缓存，小文件从内存整发
+        if file_type != "video":
+            st = full_media_path.stat()
+            etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
             headers = {
+                "ETag": etag,
                 "Content-Disposition": f"inline; filename=\"{encoded_filename}\"; filename*=UTF-8''{encoded_filename}"
             }
-            
-            return FileResponse(
+            if file_type == "image":
+                headers["Cache-Control"] = "max-age=3600"
+
+            if request.headers.get("if-none-match") == etag:
+                return Response(status_code=304, headers=headers)
+
+            logger.info(f"Serving {file_type}: {full_media_path}")
+
+            if st.st_size <= SMALL_FILE_CACHE_LIMIT:
+                content = _read_small_file(str(full_media_path), st.st_mtime_ns, st.st_size)
+                return Response(content=content, media_type=mime_type, headers=headers)
+
+            return MediaFileResponse(
                 path=str(full_media_path),
                 media_type=mime_type,
-                filename=encoded_filename,
                 headers=headers
             )
-        
-        # 视频处理断点续传
-        file_size = full_media_path.stat().st_size
-        range_header = request.headers.get("Range")
-        
-        if range_header:
-            try:
-                range_str = range_header.split("=")[-1]
-                start_str, end_str = range_str.split("-")
-                start = int(start_str) if start_str else 0
-                end = int(end_str) if end_str else file_size - 1
-                end = min(end, file_size - 1)
-                start = max(0, start)
-            except:
-                start = 0
-                end = min(1024*1024*2, file_size - 1)
-        else:
-            start = 0
-            end = min(1024*1024*2, file_size - 1)
-        
-        # 异步分块读取
-        async def iterfile():
-            async with aiofiles.open(str(full_media_path), 'rb') as f:
-                await f.seek(start)
-                remaining = end - start + 1
-                while remaining > 0:
-                    chunk_size = min(1024*1024, remaining)
-                    chunk = await f.read(chunk_size)
-                    if not chunk:
-                        break
-                    yield chunk
-                    remaining -= chunk_size
-        
-        # 处理视频文件名
-        filename = full_media_path.name
-        encoded_filename = encode_filename_for_header(filename)
-        
+
+        # 视频：Range/断点续传交给FileResponse处理
         headers = {
-            "Content-Range": f"bytes {start}-{end}/{file_size}",
-            "Accept-Ranges": "bytes",
-            "Content-Length": str(end - start + 1),
-            "Content-Type": mime_type,
             "Content-Disposition": f"inline; filename=\"{encoded_filename}\"; filename*=UTF-8''{encoded_filename}"
         }
-        
-        logger.info(f"Serving video: {full_media_path} (bytes {start}-{end}/{file_size})")
-        return StreamingResponse(
-            iterfile(),
-            status_code=206,
-            headers=headers,
-            media_type=mime_type
+
+        logger.info(f"Serving video: {full_media_path}")
+        return MediaFileResponse(
+            path=str(full_media_path),
+            media_type=mime_type,
+            headers=headers
         )
         
     except HTTPException as e:
@@ -512,25 +630,24 @@ async def serve_media(path: str, request: Request):
 
 # 获取所有目录路径
 @app.get("/api/all-directories")
-async def get_all_directories():
+async def get_all_directories(nocache: bool = False):
     all_dirs = []
-    
-    def traverse_all_dirs(path: Path, rel_path: str = ""):
+
+    def traverse_all_dirs(path: str, rel_path: str = ""):
         try:
             all_dirs.append({
                 "name": rel_path if rel_path else "主目录",
                 "path": rel_path,
                 "protected": is_protected_directory(rel_path)
             })
-            for dir in path.iterdir():
-                if dir.is_dir() and not dir.name.startswith('.'):
-                    sub_rel = f"{rel_path}/{dir.name}" if rel_path else dir.name
-                    traverse_all_dirs(dir, sub_rel)
+            for name in _list_subdirs(path, nocache):
+                sub_rel = f"{rel_path}/{name}" if rel_path else name
+                traverse_all_dirs(os.path.join(path, name), sub_rel)
         except Exception as e:
             logger.error(f"Error traversing all directories: {e}")
-    
+
     if VIDEO_ROOT.exists():
-        traverse_all_dirs(VIDEO_ROOT)
+        traverse_all_dirs(str(VIDEO_ROOT))
     return {"directories": all_dirs}
 
 
@@ -576,6 +693,8 @@ async def create_directory(
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"创建目录失败：{str(e)}")
         
+        _KNOWN_DIRS.add(str(new_dir_path))
+
         # 设置密码保护
         if dir_password and dir_password.strip():
             save_directory_password(new_dir_rel_path, dir_password.strip())
@@ -595,6 +714,51 @@ async def create_directory(
         logger.error(f"创建目录异常: {e}", exc_info=True)
         return {"success": False, "message": f"创建失败: {str(e)}"}
 
+# 上传落盘块大小
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# 已确认存在的上传目录，热门目录不必每次上传都逐级makedirs/stat
+_KNOWN_DIRS: set = set()
+
+def _save_upload_file(src, dst_path: str) -> int:
+    """同步把上传内容一次性写到目标路径（在工作线程中执行），返回写入字节数
+
+    O_EXCL打开失败说明文件不归本次请求所有，不做任何清理；
+    打开成功后拷贝中途出错则删掉自己写了一半的文件再抛出。
+    """
+    fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        try:
+            src.seek(0, os.SEEK_END)
+            total = src.tell()
+            src.seek(0)
+
+            # SpooledTemporaryFile已落盘时有真实fd，可走内核sendfile零拷贝
+            if getattr(src, '_rolled', False) and hasattr(os, 'sendfile'):
+                src_fd = src.fileno()
+                offset = 0
+                while offset < total:
+                    sent = os.sendfile(fd, src_fd, offset, total - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                return offset
+
+            written = 0
+            while chunk := src.read(UPLOAD_CHUNK_SIZE):
+                os.write(fd, chunk)
+                written += len(chunk)
+            return written
+        finally:
+            os.close(fd)
+    except BaseException:
+        # 只清理本次请求创建的半成品文件
+        try:
+            os.unlink(dst_path)
+        except OSError:
+            pass
+        raise
+
 @app.post("/api/upload-media")
 async def upload_media(
     request: Request,
@@ -613,42 +777,45 @@ async def upload_media(
             return {"success": False, "message": "未选择文件"}
         
         filename = file.filename
-        file_ext = Path(filename).suffix.lower()
+        file_ext = get_file_ext(filename)
         if file_ext not in SUPPORTED_EXTENSIONS:
             logger.warning(f"上传失败：不支持的文件格式 {file_ext}")
             return {
                 "success": False, 
-                "message": f"不支持的文件格式: {file_ext}，支持的格式: {', '.join(SUPPORTED_EXTENSIONS)}"
+                "message": f"不支持的文件格式: {file_ext}，支持的格式: {', '.join(sorted(SUPPORTED_EXTENSIONS))}"
             }
         
         if target_dir.strip():
             upload_dir = safe_join(VIDEO_ROOT, target_dir.strip())
+            upload_dir_str = str(upload_dir)
+            if upload_dir_str not in _KNOWN_DIRS:
+                os.makedirs(upload_dir, exist_ok=True)
+                _KNOWN_DIRS.add(upload_dir_str)
         else:
+            # 根目录启动时已确认存在，无需makedirs
             upload_dir = VIDEO_ROOT
-        
-        os.makedirs(upload_dir, exist_ok=True)
         logger.info(f"上传目录已确认: {upload_dir}")
         
         file_path = upload_dir / filename
+        stem = os.path.splitext(filename)[0]
         counter = 1
         while file_path.exists():
-            stem = Path(filename).stem
             new_filename = f"{stem}_{counter}{file_ext}"
             file_path = upload_dir / new_filename
             counter += 1
         
         try:
-            async with aiofiles.open(str(file_path), 'wb') as f:
-                content_length = 0
-                while chunk := await file.read(1024 * 1024):
-                    await f.write(chunk)
-                    content_length += len(chunk)
-            
-            if not file_path.exists():
+            # 整个拷贝只占用一次线程池调度，而不是每1MiB块来回两跳
+            content_length = await run_in_threadpool(_save_upload_file, file.file, str(file_path))
+
+            # 落盘结果只stat一次，大小复用同一结果
+            try:
+                file_size = os.stat(file_path).st_size
+            except FileNotFoundError:
                 raise Exception("文件保存失败：文件不存在")
-            if file_path.stat().st_size != content_length:
-                logger.warning(f"文件大小不一致 - 预期: {content_length}, 实际: {file_path.stat().st_size}")
-            
+            if file_size != content_length:
+                logger.warning(f"文件大小不一致 - 预期: {content_length}, 实际: {file_size}")
+
             # 确定文件类型
             if file_ext in SUPPORTED_VIDEO_FORMATS:
                 file_type = "视频"
@@ -656,22 +823,19 @@ async def upload_media(
                 file_type = "音频"
             else:
                 file_type = "图片"
-            
-            logger.info(f"文件上传成功: {file_path} ({file_type}, {file_path.stat().st_size} bytes)")
-            
+
+            logger.info(f"文件上传成功: {file_path} ({file_type}, {file_size} bytes)")
+
             return {
                 "success": True,
                 "message": f"{file_type}文件 {file_path.name} 上传成功",
                 "filename": file_path.name,
                 "path": target_dir,
-                "size": file_path.stat().st_size
+                "size": file_size
             }
-            
+
         except Exception as e:
-            # 清理不完整文件
-            if file_path.exists() and file_path.stat().st_size == 0:
-                file_path.unlink()
-                logger.warning(f"清理空文件: {file_path}")
+            # 半成品清理在_save_upload_file里完成，别人的文件这里不能动
             raise Exception(f"保存文件失败: {str(e)}")
             
     except Exception as e:
@@ -708,6 +872,16 @@ async def clear_dir_auth(dir_path: str = Form(...)):
 async def get_protected_dirs():
     return {"protected_dirs": get_protected_directories()}
 
+@app.on_event("startup")
+async def warm_caches():
+    """启动即预热密码缓存/前缀树并预读根目录，首批请求不付冷启动代价"""
+    try:
+        _load_passwords()
+        if VIDEO_ROOT.exists():
+            _list_subdirs(str(VIDEO_ROOT))
+    except Exception as e:
+        logger.warning(f"缓存预热失败: {e}")
+
 def create_listen_sockets(port: int) -> list:
     sockets = []
 
@@ -737,7 +911,10 @@ def create_listen_sockets(port: int) -> list:
     return sockets
 
 def main():
+    _log_listener.start()
     init_password_file()
+    # 提前填充密码缓存，顺带把根目录inode带进内核dentry缓存
+    _load_passwords()
     import uvicorn
     sockets = create_listen_sockets(PORT)
     config = uvicorn.Config(
@@ -749,7 +926,10 @@ def main():
     )
 
     server = uvicorn.Server(config)
-    server.run(sockets=sockets)
+    try:
+        server.run(sockets=sockets)
+    finally:
+        _log_listener.stop()
 
 if __name__ == "__main__":
     main()